@@ -17,7 +17,7 @@ def create_tutorial_flow():
     identify_abstractions = IdentifyAbstractions(max_retries=5, wait=20)
     analyze_relationships = AnalyzeRelationships(max_retries=5, wait=20)
     order_chapters = OrderChapters(max_retries=5, wait=20)
-    write_chapters = WriteChapters(max_retries=5, wait=20) # This is a BatchNode
+    write_chapters = WriteChapters(max_retries=5, wait=20, max_workers=4, chapters_per_call=3) # This is a BatchNode, chapter batches are written concurrently
     combine_tutorial = CombineTutorial()
 
     # Connect nodes in sequence based on the design
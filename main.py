@@ -98,6 +98,13 @@ def main():
         help="Maximum file size in bytes (default: 100000, about 100KB).",
     )
 
+    parser.add_argument(
+        "--max-context-tokens",
+        type=int,
+        default=700000,
+        help="Approximate token budget for the codebase context sent to the LLM (default: 700000).",
+    )
+
     args = parser.parse_args()
 
     # Get GitHub token from argument or environment variable if using repo
@@ -124,11 +131,16 @@ def main():
         if args.exclude
         else DEFAULT_EXCLUDE_PATTERNS,
         "max_file_size": args.max_size,
+        "max_context_tokens": args.max_context_tokens,
         # Outputs will be populated by the nodes
-        "files": [],
+        "files": (),
+        "file_headers": [],
+        "file_context_keys": [],
+        "file_listing_for_prompt": "",
         "abstractions": [],
         "relationships": {},
         "chapter_order": [],
+        "chapter_filenames": {},
         "chapters": [],
         "final_output_dir": None,
     }
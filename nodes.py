@@ -1,10 +1,16 @@
 import logging
 import os
-import yaml
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, List
+from pydantic import BaseModel, BeforeValidator, ConfigDict, TypeAdapter
 from pocketflow import Node, BatchNode
 from utils.crawl_github_files import crawl_github_files
 from utils.call_llm import call_llm
 from utils.crawl_local_files import crawl_local_files
+from utils.patterns import compile_patterns
+
 
 # Configure logging
 logging.basicConfig(
@@ -12,16 +18,169 @@ logging.basicConfig(
 )
 
 
+# Prompts put their static instructions first and the per-project text last, so the
+# provider can reuse the cached prompt prefix across calls.
+
+
+# Matches the ```json fenced block in LLM responses. JSON strings can't contain raw
+# newlines, so a fence at the start of a line always closes the block.
+_JSON_FENCE = re.compile(r"```json\s*\n(.*?)\n```", re.DOTALL)
+
+
+# Leading integer of an index entry such as `3`, `"3"` or `"3 # path/to/file.py"`
+_INDEX_PREFIX = re.compile(r"^\s*(\d+)")
+
+
+# Helper to parse an index entry produced by the LLM
+def parse_index(entry):
+    match = _INDEX_PREFIX.match(str(entry))
+    if match is None:
+        raise ValueError(f"Could not parse index from entry: {entry}")
+    return int(match.group(1))
+
+
+# Footer appended to every generated file
+_ATTRIBUTION = (
+    "---\n\nGenerated by [Rules for AI](https://github.com/altaidevorg/rules-for-ai)"
+)
+
+# Frontmatter of guide.mdc, the always-applied entry rule
+_GUIDE_HEADER_TMPL = (
+    "---\ndescription: Guidelines for using {name}\nglobs: \nalwaysApply: true\n---\n"
+)
+
+# A chapter file: the rule frontmatter followed by the Markdown content
+_CHAPTER_TMPL = (
+    "---\ndescription: {description}\nglobs: {globs}\nalwaysApply: {always_apply}\n---\n"
+    "{content}"
+)
+
+
+# Filename sanitization: every character that isn't alphanumeric becomes "_".
+# ASCII names go through a translate table; for other names \W matches exactly the
+# characters str.isalnum() rejects (plus "_", which maps to itself).
+_SAFE_NAME_TABLE = {i: "_" for i in range(128) if not chr(i).isalnum()}
+_UNSAFE_NAME_CHARS = re.compile(r"\W")
+
+
+# Helper to turn an abstraction name into a safe, lowercase filename stem
+def sanitize_name(name):
+    if name.isascii():
+        return name.translate(_SAFE_NAME_TABLE).lower()
+    return _UNSAFE_NAME_CHARS.sub("_", name).lower()
+
+
+# Helper to estimate the token count of a prompt fragment. Roughly 4 characters per
+# token for code and English text; close enough for budgeting without a tokenizer.
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+# Helper to rank files for the LLM context: READMEs and package __init__ files first,
+# then shallower paths, then larger files. Lower sorts first.
+def context_priority(path, content):
+    file_name = os.path.basename(path).lower()
+    is_entry_point = file_name.startswith("readme") or file_name == "__init__.py"
+    return (not is_entry_point, path.count("/"), -len(content))
+
+
+# Helper to get the JSON payload from an LLM response. JSON-mode responses have no
+# fence and are returned as-is.
+def extract_json(response):
+    match = _JSON_FENCE.search(response)
+    return match.group(1) if match else response.strip()
+
+
+# Keeps Windows from translating newlines in os.open()ed files; 0 elsewhere
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+# Helper to write one generated file, given as a (path, utf-8 bytes) pair.
+# The bytes go straight to the file descriptor, without Python file objects.
+def write_output_file(path_and_content):
+    path, content = path_and_content
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o644)
+    try:
+        view = memoryview(content)
+        while view:  # os.write may write fewer bytes than requested
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+    logging.info(f"  - Wrote {path}")
+
+
 # Helper to get content for specific file indices
-def get_content_for_indices(files_data, indices):
-    content_map = {}
-    for i in indices:
-        if 0 <= i < len(files_data):
-            path, content = files_data[i]
-            content_map[f"{i} # {path}"] = (
-                content  # Use index + path as key for context
-            )
-    return content_map
+# context_keys are the "index # path" keys precomputed by FetchRepo
+def get_content_for_indices(files_data, context_keys, indices):
+    num_files = len(files_data)
+    # Use index + path as key for context
+    return {
+        context_keys[i]: files_data[i][1] for i in indices if 0 <= i < num_files
+    }
+
+
+# --- Schemas for validating LLM output ---
+# Strict models reject type coercion (e.g. a number where a name is expected),
+# while Index accepts the `idx # comment` entries the prompts ask for.
+Index = Annotated[int, BeforeValidator(parse_index)]
+
+
+# An empty globs value means "no globs"; the frontmatter keeps a single space for it
+def normalize_globs(value):
+    if value is None or value == []:
+        return " "
+    return value.strip() if isinstance(value, str) else value
+
+
+class Abstraction(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    name: str
+    description: str
+    file_indices: List[Index]
+
+
+class Relationship(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    from_abstraction: Index
+    to_abstraction: Index
+    label: str
+
+
+class RelationshipsResult(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    summary: str
+    relationships: List[Relationship]
+
+
+class Chapter(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    chapter_num: Index
+    description: str
+    globs: Annotated[str, BeforeValidator(normalize_globs)]
+    alwaysApply: bool
+    content: str
+
+
+# Validators for the top-level lists, built once
+AbstractionList = TypeAdapter(List[Abstraction])
+ChapterOrder = TypeAdapter(List[Index])
+ChapterList = TypeAdapter(List[Chapter])
+
+
+# Helper to parse a batched chapter response and split it into per-chapter records.
+# Pure and module-level so it can run in any worker, away from the node instance.
+def parse_chapters(response, chapter_nums):
+    chapters = ChapterList.validate_json(extract_json(response))
+    chapters_by_num = {chapter.chapter_num: chapter for chapter in chapters}
+
+    missing_nums = [num for num in chapter_nums if num not in chapters_by_num]
+    if missing_nums:
+        raise ValueError(f"LLM output is missing chapters {missing_nums}")
+    return chapters_by_num
 
 
 class FetchRepo(Node):
@@ -37,10 +196,13 @@ class FetchRepo(Node):
             else:
                 project_name = os.path.basename(os.path.abspath(local_dir))
             shared["project_name"] = project_name
+        # Scopes the semantic LLM cache, so prompts that differ only in their
+        # per-project text never reuse another project's responses
+        shared["project_source"] = repo_url or os.path.abspath(local_dir)
 
-        # Get file patterns directly from shared
-        include_patterns = shared["include_patterns"]
-        exclude_patterns = shared["exclude_patterns"]
+        # Compile the file patterns from shared once; the crawlers reuse the matchers for every file
+        include_patterns = compile_patterns(shared["include_patterns"])
+        exclude_patterns = compile_patterns(shared["exclude_patterns"])
         max_file_size = shared["max_file_size"]
 
         return {
@@ -74,15 +236,26 @@ class FetchRepo(Node):
                 use_relative_paths=prep_res["use_relative_paths"],
             )
 
-        # Convert dict to list of tuples: [(path, content), ...]
-        files_list = list(result.get("files", {}).items())
-        if len(files_list) == 0:
+        # Convert dict to an immutable, indexable tuple: ((path, content), ...)
+        # Downstream nodes share it and look files up by index.
+        files_data = tuple(result.get("files", {}).items())
+        if len(files_data) == 0:
             raise (ValueError("Failed to fetch files"))
-        logging.info(f"Fetched {len(files_list)} files.")
-        return files_list
+        logging.info(f"Fetched {len(files_data)} files.")
+        return files_data
 
     def post(self, shared, prep_res, exec_res):
-        shared["files"] = exec_res  # List of (path, content) tuples
+        shared["files"] = exec_res  # Tuple of (path, content) tuples
+        # Per-file prompt fragments, built once here and reused by the LLM nodes
+        shared["file_headers"] = [
+            f"--- File Index {i}: {path} ---\n" for i, (path, _) in enumerate(exec_res)
+        ]
+        shared["file_context_keys"] = [
+            f"{i} # {path}" for i, (path, _) in enumerate(exec_res)
+        ]
+        shared["file_listing_for_prompt"] = "\n".join(
+            f"- {key}" for key in shared["file_context_keys"]
+        )
 
 
 class IdentifyAbstractions(Node):
@@ -90,121 +263,127 @@ class IdentifyAbstractions(Node):
         files_data = shared["files"]
         project_name = shared["project_name"]  # Get project name
 
-        # Helper to create context from files, respecting limits (basic example)
-        def create_llm_context(files_data):
-            context = ""
-            file_info = []  # Store tuples of (index, path)
-            for i, (path, content) in enumerate(files_data):
-                entry = f"--- File Index {i}: {path} ---\n{content}\n\n"
-                context += entry
-                file_info.append((i, path))
-
-            return context, file_info  # file_info is list of (index, path)
-
-        context, file_info = create_llm_context(files_data)
-        # Format file info for the prompt (comment is just a hint for LLM)
-        file_listing_for_prompt = "\n".join(
-            [f"- {idx} # {path}" for idx, path in file_info]
-        )
+        file_headers = shared["file_headers"]
+
+        # Group files with identical content (e.g. empty __init__.py files, vendored
+        # copies) so each body is sent once. The str itself is the dict key: hashing
+        # is a single pass and, unlike a digest, can't collide.
+        indices_by_content = {}
+        for i, (_, content) in enumerate(files_data):
+            indices_by_content.setdefault(content, []).append(i)
+
+        # One context entry per distinct content, using the headers precomputed by FetchRepo
+        entries = []
+        for content, indices in indices_by_content.items():
+            if len(indices) == 1:
+                header = file_headers[indices[0]]
+            else:
+                indices_str = ",".join(map(str, indices))
+                paths_str = " / ".join(files_data[i][0] for i in indices)
+                header = f"--- File Indices {indices_str}: {paths_str} ---\n"
+            entries.append((files_data[indices[0]][0], header, content))
+
+        # Keep the context within the token budget: greedily take the highest-ranked
+        # entries that still fit. Omitted files stay in the file listing, so the LLM
+        # still knows they exist.
+        max_context_tokens = shared.get("max_context_tokens")
+        if max_context_tokens:
+            ranked = sorted(
+                range(len(entries)),
+                key=lambda e: context_priority(entries[e][0], entries[e][2]),
+            )
+            kept, used_tokens = set(), 0
+            for e in ranked:
+                _, header, content = entries[e]
+                entry_tokens = estimate_tokens(header) + estimate_tokens(content)
+                if used_tokens + entry_tokens <= max_context_tokens:
+                    kept.add(e)
+                    used_tokens += entry_tokens
+            if len(kept) < len(entries):
+                logging.warning(
+                    f"Context budget of {max_context_tokens} tokens reached, sending {len(kept)} of {len(entries)} distinct files."
+                )
+                # Preserve the original file order for the kept entries
+                entries = [entry for e, entry in enumerate(entries) if e in kept]
+
+        # A single join avoids re-copying the growing string for every file
+        context = "".join(f"{header}{content}\n\n" for _, header, content in entries)
         return (
             context,
-            file_listing_for_prompt,
+            shared["file_listing_for_prompt"],  # comment is just a hint for LLM
             len(files_data),
             project_name,
+            shared["project_source"],
         )
 
     def exec(self, prep_res):
-        context, file_listing_for_prompt, file_count, project_name = (
+        context, file_listing_for_prompt, file_count, project_name, project_source = (
             prep_res  # Unpack project name and other extracted data
         )
         logging.info("Identifying abstractions using LLM...")
 
         prompt = f"""
-For the project `{project_name}`:
-
-Codebase Context:
-{context}
-
-Analyze the codebase context.
+Analyze the codebase context given at the end.
 Identify the top 5-10 core most important abstractions to help an AI coding agent new to the codebase.
 
 For each abstraction, provide:
 1. A concise `name`.
 2. An knowledge-dense `description` explaining what it does and when to use it with references to the specific problems that it solves and software engineering concepts that it uses, such as design patterns, data structures, algorithms etc. if applicable , in around 200 words.
-3. A list of relevant `file_indices` (integers) using the format `idx # path/comment`.
+3. A list of relevant `file_indices`, each a string using the format `idx # path/comment`.
+
+Format the output as a JSON list of objects:
+
+```json
+[
+  {{
+    "name": "Node",
+    "description": "Explains what the abstraction does.\\nIt is the base class used to build directed graphs.",
+    "file_indices": ["0 # path/to/file1.py", "3 # path/to/related.py"]
+  }},
+  {{
+    "name": "Flow",
+    "description": "It is composed of multiple nodes connected to each other to define a conditional execution of any workflow.",
+    "file_indices": ["5 # path/to/another.js"]
+  }}
+]
+```
+List up to 10 abstractions.
+
+For the project `{project_name}`:
 
 List of file indices and paths present in the context:
 {file_listing_for_prompt}
 
-Format the output as a YAML list of dictionaries:
-
-```yaml
-- name: |
-    Node
-  description: |
-    Explains what the abstraction does.
-    It is the base class used to build directed graphs.
-  file_indices:
-    - 0 # path/to/file1.py
-    - 3 # path/to/related.py
-- name: |
-    Flow
-  description: |
-    It is composed of multiple nodes connected to each other to define a conditional execution of any workflow.
-  file_indices:
-    - 5 # path/to/another.js
-# ... up to 10 abstractions
-```"""
-        response = call_llm(prompt)
+Codebase Context:
+{context}
 
-        # --- Validation ---
-        yaml_str = response.strip().split("```yaml")[1].split("```")[0].strip()
-        abstractions = yaml.safe_load(yaml_str)
+Now, provide the JSON output:
+"""
+        response = call_llm(
+            prompt,
+            semantic_scope=project_source if self.cur_retry == 0 else None,
+            response_mime_type="application/json",
+        )
 
-        if not isinstance(abstractions, list):
-            raise ValueError("LLM Output is not a list")
+        # --- Validation ---
+        abstractions = AbstractionList.validate_json(extract_json(response))
 
         validated_abstractions = []
         for item in abstractions:
-            if not isinstance(item, dict) or not all(
-                k in item for k in ["name", "description", "file_indices"]
-            ):
-                raise ValueError(f"Missing keys in abstraction item: {item}")
-            if not isinstance(item["name"], str):
-                raise ValueError(f"Name is not a string in item: {item}")
-            if not isinstance(item["description"], str):
-                raise ValueError(f"Description is not a string in item: {item}")
-            if not isinstance(item["file_indices"], list):
-                raise ValueError(f"file_indices is not a list in item: {item}")
-
             # Validate indices
-            validated_indices = []
-            for idx_entry in item["file_indices"]:
-                try:
-                    if isinstance(idx_entry, int):
-                        idx = idx_entry
-                    elif isinstance(idx_entry, str) and "#" in idx_entry:
-                        idx = int(idx_entry.split("#")[0].strip())
-                    else:
-                        idx = int(str(idx_entry).strip())
-
-                    if not (0 <= idx < file_count):
-                        raise ValueError(
-                            f"Invalid file index {idx} found in item {item['name']}. Max index is {file_count - 1}."
-                        )
-                    validated_indices.append(idx)
-                except (ValueError, TypeError):
+            for idx in item.file_indices:
+                if not (0 <= idx < file_count):
                     raise ValueError(
-                        f"Could not parse index from entry: {idx_entry} in item {item['name']}"
+                        f"Invalid file index {idx} found in item {item.name}. Max index is {file_count - 1}."
                     )
 
-            item["files"] = sorted(list(set(validated_indices)))
-            # Store only the required fields
+            # Store only the required fields. The model usually lists indices in
+            # ascending order, so an order-preserving dedup leaves Timsort a single run.
             validated_abstractions.append(
                 {
-                    "name": item["name"].strip(),
-                    "description": item["description"].strip(),
-                    "files": item["files"],
+                    "name": item.name.strip(),
+                    "description": item.description.strip(),
+                    "files": sorted(dict.fromkeys(item.file_indices)),
                 }
             )
 
@@ -224,51 +403,45 @@ class AnalyzeRelationships(Node):
         project_name = shared["project_name"]  # Get project name
 
         # Create context with abstraction names, indices, descriptions, and relevant file snippets
-        context = "Identified Abstractions:\n"
+        context_parts = ["Identified Abstractions:\n"]
         all_relevant_indices = set()
         abstraction_info_for_prompt = []
         for i, abstr in enumerate(abstractions):
             # Use 'files' which contains indices directly
             file_indices_str = ", ".join(map(str, abstr["files"]))
             info_line = f"- Index {i}: {abstr['name']} (Relevant file indices: [{file_indices_str}])\n  Description: {abstr['description']}"
-            context += info_line + "\n"
+            context_parts.append(info_line + "\n")
             abstraction_info_for_prompt.append(f"{i} # {abstr['name']}")
             all_relevant_indices.update(abstr["files"])
 
-        context += "\nRelevant File Snippets (Referenced by Index and Path):\n"
+        context_parts.append("\nRelevant File Snippets (Referenced by Index and Path):\n")
         # Get content for relevant files using helper
         relevant_files_content_map = get_content_for_indices(
-            files_data, sorted(list(all_relevant_indices))
+            files_data, shared["file_context_keys"], sorted(all_relevant_indices)
         )
         # Format file content for context
         file_context_str = "\n\n".join(
             f"--- File: {idx_path} ---\n{content}"
             for idx_path, content in relevant_files_content_map.items()
         )
-        context += file_context_str
+        context_parts.append(file_context_str)
 
         return (
-            context,
+            "".join(context_parts),
             "\n".join(abstraction_info_for_prompt),
+            len(abstractions),
             project_name,
+            shared["project_source"],
         )
 
     def exec(self, prep_res):
-        context, abstraction_listing, project_name = (
+        context, abstraction_listing, num_abstractions, project_name, project_source = (
             prep_res  # Unpack project name and other extracted data
         )
         logging.info("Analyzing relationships using LLM...")
 
         prompt = f"""
-Based on the following abstractions and relevant code snippets from the project `{project_name}`:
-
-List of Abstraction Indices and Names:
-{abstraction_listing}
-
-Context (Abstractions, Descriptions, Code):
-{context}
-
-Please provide:
+Based on the abstractions and relevant code snippets of the project given at the end, please provide:
 1. A technical `summary` of the project's main purpose and functionality in a style similar to a transfer document with references to relevant software engineering concepts if applicable. Use markdown formatting with **bold** and *italic* text to highlight important concepts.
 2. A list (`relationships`) describing the key interactions between these abstractions. For each relationship, specify:
     - `from_abstraction`: Index of the source abstraction (e.g., `0 # AbstractionName1`)
@@ -279,80 +452,69 @@ Please provide:
 
 IMPORTANT: Make sure EVERY abstraction is involved in at least ONE relationship (either as source or target). Each abstraction index must appear at least once across all relationships.
 
-Format the output as YAML:
-
-```yaml
-summary: |
-  A brief, technical explanation of the project.
-  Can span multiple lines with **bold** and *italic* for emphasis.
-  Think of it as a transfer document summarizing the architecture and/or design, overview of problems tackled, solutions provided and conventions followed from the perspective of software engineering.
-relationships:
-  - from_abstraction: 0 # AbstractionName1
-    to_abstraction: 1 # AbstractionName2
-    label: "Manages"
-  - from_abstraction: 2 # AbstractionName3
-    to_abstraction: 0 # AbstractionName1
-    label: "Provides config"
-  # ... other relationships
+Format the output as a JSON object:
+
+```json
+{{
+  "summary": "A brief, technical explanation of the project.\\nCan span multiple lines with **bold** and *italic* for emphasis.\\nThink of it as a transfer document summarizing the architecture and/or design, overview of problems tackled, solutions provided and conventions followed from the perspective of software engineering.",
+  "relationships": [
+    {{
+      "from_abstraction": "0 # AbstractionName1",
+      "to_abstraction": "1 # AbstractionName2",
+      "label": "Manages"
+    }},
+    {{
+      "from_abstraction": "2 # AbstractionName3",
+      "to_abstraction": "0 # AbstractionName1",
+      "label": "Provides config"
+    }}
+  ]
+}}
 ```
 
-Now, provide the YAML output:
+Project: `{project_name}`
+
+List of Abstraction Indices and Names:
+{abstraction_listing}
+
+Context (Abstractions, Descriptions, Code):
+{context}
+
+Now, provide the JSON output:
 """
-        response = call_llm(prompt)
+        response = call_llm(
+            prompt,
+            semantic_scope=project_source if self.cur_retry == 0 else None,
+            response_mime_type="application/json",
+        )
 
         # --- Validation ---
-        yaml_str = response.strip().split("```yaml")[1].split("```")[0].strip()
-        relationships_data = yaml.safe_load(yaml_str)
-
-        if not isinstance(relationships_data, dict) or not all(
-            k in relationships_data for k in ["summary", "relationships"]
-        ):
-            raise ValueError(
-                "LLM output is not a dict or missing keys ('summary', 'relationships')"
-            )
-        if not isinstance(relationships_data["summary"], str):
-            raise ValueError("summary is not a string")
-        if not isinstance(relationships_data["relationships"], list):
-            raise ValueError("relationships is not a list")
+        relationships_data = RelationshipsResult.model_validate_json(
+            extract_json(response)
+        )
 
-        # Validate relationships structure
+        # Validate relationship indices
         validated_relationships = []
-        num_abstractions = len(abstraction_listing.split("\n"))
-        for rel in relationships_data["relationships"]:
-            # Check for 'label' key
-            if not isinstance(rel, dict) or not all(
-                k in rel for k in ["from_abstraction", "to_abstraction", "label"]
+        for rel in relationships_data.relationships:
+            from_idx = rel.from_abstraction
+            to_idx = rel.to_abstraction
+            if not (
+                0 <= from_idx < num_abstractions and 0 <= to_idx < num_abstractions
             ):
                 raise ValueError(
-                    f"Missing keys (expected from_abstraction, to_abstraction, label) in relationship item: {rel}"
+                    f"Invalid index in relationship: from={from_idx}, to={to_idx}. Max index is {num_abstractions - 1}."
                 )
-            # Validate 'label' is a string
-            if not isinstance(rel["label"], str):
-                raise ValueError(f"Relationship label is not a string: {rel}")
-
-            # Validate indices
-            try:
-                from_idx = int(str(rel["from_abstraction"]).split("#")[0].strip())
-                to_idx = int(str(rel["to_abstraction"]).split("#")[0].strip())
-                if not (
-                    0 <= from_idx < num_abstractions and 0 <= to_idx < num_abstractions
-                ):
-                    raise ValueError(
-                        f"Invalid index in relationship: from={from_idx}, to={to_idx}. Max index is {num_abstractions - 1}."
-                    )
-                validated_relationships.append(
-                    {
-                        "from": from_idx,
-                        "to": to_idx,
-                        "label": rel["label"],  # Potentially translated label
-                    }
-                )
-            except (ValueError, TypeError):
-                raise ValueError(f"Could not parse indices from relationship: {rel}")
+            validated_relationships.append(
+                {
+                    "from": from_idx,
+                    "to": to_idx,
+                    "label": rel.label,  # Potentially translated label
+                }
+            )
 
         logging.info("Generated project summary and relationship details.")
         return {
-            "summary": relationships_data["summary"],  # Potentially translated summary
+            "summary": relationships_data.summary,  # Potentially translated summary
             "details": validated_relationships,  # Store validated, index-based relationships with potentially translated labels
         }
 
@@ -373,26 +535,48 @@ class OrderChapters(Node):
             abstraction_info_for_prompt.append(f"- {i} # {a['name']}")
         abstraction_listing = "\n".join(abstraction_info_for_prompt)
 
-        context = f"Project Summary:\n{relationships['summary']}\n\n"
-        context += "Relationships (Indices refer to abstractions above):\n"
+        context_parts = [
+            f"Project Summary:\n{relationships['summary']}\n\n",
+            "Relationships (Indices refer to abstractions above):\n",
+        ]
         for rel in relationships["details"]:
             from_name = abstractions[rel["from"]]["name"]
             to_name = abstractions[rel["to"]]["name"]
             # Use potentially translated 'label'
-            context += f"- From {rel['from']} ({from_name}) to {rel['to']} ({to_name}): {rel['label']}\n"  # Label might be translated
+            context_parts.append(
+                f"- From {rel['from']} ({from_name}) to {rel['to']} ({to_name}): {rel['label']}\n"
+            )  # Label might be translated
 
         return (
             abstraction_listing,
-            context,
+            "".join(context_parts),
             len(abstractions),
             project_name,
+            shared["project_source"],
         )
 
     def exec(self, prep_res):
-        abstraction_listing, context, num_abstractions, project_name = prep_res
+        (
+            abstraction_listing,
+            context,
+            num_abstractions,
+            project_name,
+            project_source,
+        ) = prep_res
         logging.info("Determining chapter order using LLM...")
         prompt = f"""
-Given the following project abstractions and their relationships for the project ```` {project_name} ````:
+Given the project abstractions and their relationships listed at the end:
+
+If you are going to make a tutorial for this project, what is the best order to explain these abstractions, from first to last?
+Ideally, first explain those that are the most important or foundational, perhaps user-facing concepts or entry points. Then move to more detailed, lower-level implementation details or supporting concepts.
+
+Output the ordered JSON list of abstraction indices, including the name in a comment for clarity. Use the string format `idx # AbstractionName`.
+
+```json
+["2 # FoundationalConcept", "0 # CoreClassA", "1 # CoreClassB (uses CoreClassA)"]
+```
+
+Project: ```` {project_name} ````
 
 Abstractions (Index # Name):
 {abstraction_listing}
@@ -400,53 +584,26 @@ Abstractions (Index # Name):
 Context about relationships and project summary:
 {context}
 
-If you are going to make a tutorial for ```` {project_name} ````, what is the best order to explain these abstractions, from first to last?
-Ideally, first explain those that are the most important or foundational, perhaps user-facing concepts or entry points. Then move to more detailed, lower-level implementation details or supporting concepts.
-
-Output the ordered list of abstraction indices, including the name in a comment for clarity. Use the format `idx # AbstractionName`.
-
-```yaml
-- 2 # FoundationalConcept
-- 0 # CoreClassA
-- 1 # CoreClassB (uses CoreClassA)
-- ...
-```
-
-Now, provide the YAML output:
+Now, provide the JSON output:
 """
-        response = call_llm(prompt)
+        response = call_llm(
+            prompt,
+            semantic_scope=project_source if self.cur_retry == 0 else None,
+            response_mime_type="application/json",
+        )
 
         # --- Validation ---
-        yaml_str = response.strip().split("```yaml")[1].split("```")[0].strip()
-        ordered_indices_raw = yaml.safe_load(yaml_str)
-
-        if not isinstance(ordered_indices_raw, list):
-            raise ValueError("LLM output is not a list")
+        ordered_indices = ChapterOrder.validate_json(extract_json(response))
 
-        ordered_indices = []
         seen_indices = set()
-        for entry in ordered_indices_raw:
-            try:
-                if isinstance(entry, int):
-                    idx = entry
-                elif isinstance(entry, str) and "#" in entry:
-                    idx = int(entry.split("#")[0].strip())
-                else:
-                    idx = int(str(entry).strip())
-
-                if not (0 <= idx < num_abstractions):
-                    raise ValueError(
-                        f"Invalid index {idx} in ordered list. Max index is {num_abstractions - 1}."
-                    )
-                if idx in seen_indices:
-                    raise ValueError(f"Duplicate index {idx} found in ordered list.")
-                ordered_indices.append(idx)
-                seen_indices.add(idx)
-
-            except (ValueError, TypeError):
+        for idx in ordered_indices:
+            if not (0 <= idx < num_abstractions):
                 raise ValueError(
-                    f"Could not parse index from ordered list entry: {entry}"
+                    f"Invalid index {idx} in ordered list. Max index is {num_abstractions - 1}."
                 )
+            if idx in seen_indices:
+                raise ValueError(f"Duplicate index {idx} found in ordered list.")
+            seen_indices.add(idx)
 
         # Check if all abstractions are included
         if len(ordered_indices) != num_abstractions:
@@ -463,30 +620,37 @@ Now, provide the YAML output:
 
 
 class WriteChapters(BatchNode):
+    def __init__(self, max_retries=1, wait=0, max_workers=4, chapters_per_call=3):
+        super().__init__(max_retries=max_retries, wait=wait)
+        self.max_workers = max_workers  # Number of batches written concurrently
+        self.chapters_per_call = chapters_per_call  # Chapters written per LLM call
+
     def prep(self, shared):
         chapter_order = shared["chapter_order"]  # List of indices
         abstractions = shared["abstractions"]  # List of dicts
         files_data = shared["files"]
-
-        # Get already written chapters to provide context
-        # We store them temporarily during the batch run, not in shared memory yet
-        # The 'previous_chapters_summary' will be built progressively in the exec context
-        self.chapters_written_so_far = []  # Use instance variable for temporary storage across exec calls
+        file_context_keys = shared["file_context_keys"]
 
         # Create a complete list of all chapters
         all_chapters = []
         chapter_filenames = {}  # Store chapter filename mapping for linking
+        # Each chapter needs its own file; guide.mdc is the index
+        used_filenames = {"guide.mdc"}
         for i, abstraction_index in enumerate(chapter_order):
             if 0 <= abstraction_index < len(abstractions):
                 chapter_num = i + 1
                 chapter_name = abstractions[abstraction_index][
                     "name"
                 ]  # Potentially translated name
-                # Create safe filename (from potentially translated name)
-                safe_name = "".join(
-                    c if c.isalnum() else "_" for c in chapter_name
-                ).lower()
-                filename = f"{safe_name}.mdc"
+                # Create safe filename (from potentially translated name), with a
+                # numeric suffix when another chapter already took the name
+                stem = sanitize_name(chapter_name)
+                filename = f"{stem}.mdc"
+                suffix = 2
+                while filename in used_filenames:
+                    filename = f"{stem}_{suffix}.mdc"
+                    suffix += 1
+                used_filenames.add(filename)
                 # Format with link (using potentially translated name)
                 all_chapters.append(f"[{chapter_name}]({filename})")
                 # Store mapping of chapter index to filename for linking
@@ -496,6 +660,9 @@ class WriteChapters(BatchNode):
                     "filename": filename,
                 }
 
+        # CombineTutorial writes the chapters under the same names the LLM linked to
+        shared["chapter_filenames"] = chapter_filenames
+
         # Create a formatted string with all chapters
         full_chapter_listing = "\n".join(all_chapters)
 
@@ -507,7 +674,7 @@ class WriteChapters(BatchNode):
                 related_file_indices = abstraction_details.get("files", [])
                 # Get content using helper, passing indices
                 related_files_content_map = get_content_for_indices(
-                    files_data, related_file_indices
+                    files_data, file_context_keys, related_file_indices
                 )
 
                 # Get previous chapter info for transitions (uses potentially translated name)
@@ -533,7 +700,6 @@ class WriteChapters(BatchNode):
                         "chapter_filenames": chapter_filenames,
                         "prev_chapter": prev_chapter,
                         "next_chapter": next_chapter,  # Add next chapter info
-                        # previous_chapters_summary will be added dynamically in exec
                     }
                 )
             else:
@@ -541,59 +707,111 @@ class WriteChapters(BatchNode):
                     f"Invalid abstraction index {abstraction_index} in chapter_order. Skipping."
                 )
 
-        logging.info(f"Preparing to write {len(items_to_process)} chapters...")
-        return items_to_process  # Iterable for BatchNode
-
-    def exec(self, item):
-        # This runs for each item prepared above
-        abstraction_name = item["abstraction_details"]["name"]
-        abstraction_description = item["abstraction_details"]["description"]
-        chapter_num = item["chapter_num"]
-        project_name = item.get("project_name")
+        # Group consecutive chapters so the shared instructions are sent once per call
+        batches = [
+            items_to_process[i : i + self.chapters_per_call]
+            for i in range(0, len(items_to_process), self.chapters_per_call)
+        ]
         logging.info(
-            f"Writing chapter {chapter_num} for: {abstraction_name} using LLM..."
+            f"Preparing to write {len(items_to_process)} chapters in {len(batches)} batches..."
         )
+        return batches  # Iterable for BatchNode
+
+    def _exec(self, items):
+        # Batches don't depend on each other's output, so the blocking LLM calls
+        # are dispatched concurrently. executor.map keeps results in chapter order.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._exec_item, items or []))
+
+    def _exec_item(self, item):
+        # Same retry/fallback semantics as Node._exec, but without the shared
+        # self.cur_retry counter so concurrent batches don't interfere
+        for retry in range(self.max_retries):
+            try:
+                return self.exec(item)
+            except Exception as e:
+                if retry == self.max_retries - 1:
+                    return self.exec_fallback(item, e)
+                if self.wait > 0:
+                    time.sleep(self.wait)
+
+    def exec(self, batch):
+        # This runs for each batch of chapters prepared above
+        project_name = batch[0]["project_name"]
+        full_chapter_listing = batch[0]["full_chapter_listing"]
+        chapter_nums = [item["chapter_num"] for item in batch]
+        logging.info(f"Writing chapters {chapter_nums} using LLM...")
+
+        # Related files are often shared between chapters, so each is sent once
+        files_content_map = {}
+        concept_sections = []
+        for item in batch:
+            files_content_map.update(item["related_files_content_map"])
+            related_paths = [
+                idx_path.split("# ")[1] if "# " in idx_path else idx_path
+                for idx_path in item["related_files_content_map"]
+            ]
+
+            # Link the neighbouring chapters for transitions. Chapters are written
+            # concurrently, so only their titles and filenames are known here.
+            prev_chapter = item["prev_chapter"]
+            next_chapter = item["next_chapter"]
+            prev_chapter_link = (
+                f"[{prev_chapter['name']}]({prev_chapter['filename']})"
+                if prev_chapter
+                else "None, this is the first chapter."
+            )
+            next_chapter_link = (
+                f"[{next_chapter['name']}]({next_chapter['filename']})"
+                if next_chapter
+                else "None, this is the last chapter."
+            )
+
+            concept_sections.append(
+                f"""### Chapter {item["chapter_num"]}: {item["abstraction_details"]["name"]}
+- Name: {item["abstraction_details"]["name"]}
+- Description:
+{item["abstraction_details"]["description"]}
+- Previous chapter: {prev_chapter_link}
+- Next chapter: {next_chapter_link}
+- Relevant files: {", ".join(related_paths) if related_paths else "No specific code snippets provided for this abstraction."}"""
+            )
 
         # Prepare file context string from the map
         file_context_str = "\n\n".join(
             f"--- File: {idx_path.split('# ')[1] if '# ' in idx_path else idx_path} ---\n{content}"
-            for idx_path, content in item["related_files_content_map"].items()
+            for idx_path, content in files_content_map.items()
         )
+        concepts_str = "\n\n".join(concept_sections)
 
-        # Get summary of chapters written *before* this one
-        # Use the temporary instance variable
-        previous_chapters_summary = "\n---\n".join(self.chapters_written_so_far)
+        chapter_nums_str = ", ".join(map(str, chapter_nums))
 
+        # The per-run chapter listing precedes the per-batch concepts, so all batches
+        # share the longest possible cached prefix
         prompt = f"""
-Write a highly informative and technical tutorial chapter to teach the following concept in the project `{project_name}` to a coding AI agent: "{abstraction_name}". This is Chapter {chapter_num}.
+Write highly informative and technical tutorial chapters to teach the concepts given at the end to a coding AI agent. Write exactly one chapter per concept.
 
-Concept Details:
-- Name: {abstraction_name}
-- Description:
-{abstraction_description}
-
-Complete Tutorial Structure:
-{item["full_chapter_listing"]}
-
-Context from previous chapters:
-{previous_chapters_summary if previous_chapters_summary else "This is the first chapter."}
-
-Relevant Code Snippets (Code itself remains unchanged):
-{file_context_str if file_context_str else "No specific code snippets provided for this abstraction."}
-
-Instructions for the chapter:
-- Output in YAML format. Provide `description`, `globs` and `alwaysApply` metadata in addition to the chapter `content` in Markdown format.
-- Start `content` with a clear heading (e.g., `# Chapter {chapter_num}: {abstraction_name}`). Use the provided concept name.
+Instructions for each chapter:
+- Output a JSON list with one object per chapter. For each chapter, provide its `chapter_num`, `description`, `globs` and `alwaysApply` metadata in addition to the chapter `content` in Markdown format.
+- Start `content` with a clear heading (e.g., `# Chapter 3: ConceptName`). Use the chapter number and concept name given in the concept details.
 - Prepend the Markdown content with metadata described below to tell the AI agent when to refer to this particular chapter:
 
-```yaml
-description: "A 10-15-word description containing the project name and abstractions / concepts detailed in this chapter. AI will decide when to refer to this chapter based on this description."
-globs: Empty or a single glob pattern string. If matched with a code file, it will be automatically picked by the AI agent whenever that file is mentioned. Empty string almost all the time. Set it to a pattern only for **very, very specific abstractions**, e.g., a single class in a file.
-alwaysApply: false almost all the time. set it to true only for **very, very central abstractions**.
-content: |
-  Full chapter content in Markdown format.
-  It can span to multiple lines and paragraphs.
-  You can use **bold** and *italic* texts for emphasis.
+- `chapter_num`: The chapter number (integer) given in the concept details.
+- `description`: A 10-15-word description containing the project name and abstractions / concepts detailed in this chapter. AI will decide when to refer to this chapter based on this description.
+- `globs`: Empty or a single glob pattern string. If matched with a code file, it will be automatically picked by the AI agent whenever that file is mentioned. Empty string almost all the time. Set it to a pattern only for **very, very specific abstractions**, e.g., a single class in a file.
+- `alwaysApply`: false almost all the time. set it to true only for **very, very central abstractions**.
+- `content`: Full chapter content in Markdown format, as a JSON string. Escape newlines, quotes and backslashes as JSON requires.
+
+```json
+[
+  {{
+    "chapter_num": 3,
+    "description": "A 10-15-word description of the chapter.",
+    "globs": "",
+    "alwaysApply": false,
+    "content": "# Chapter 3: ConceptName\\n\\nFull chapter content in Markdown format.\\nIt can span to multiple lines and paragraphs.\\nYou can use **bold** and *italic* texts for emphasis."
+  }}
+]
 ```
 
 - If this is not the first chapter, begin with a brief transition from the previous chapter referencing it with a proper Markdown link using its name.
@@ -612,7 +830,7 @@ content: |
 
 - Then dive deeper into code for the internal implementation with references to files. Provide example code blocks, but keep it minimal  and knowledge-dense, and do so only to help the AI agent better understand the inner working of the code at a higher level.
 
-- IMPORTANT: When you need to refer to other core abstractions covered in other chapters, ALWAYS use proper Markdown links like this: [Chapter Title](filename.md). Use the Complete Tutorial Structure above to find the correct filename and the chapter title.
+- IMPORTANT: When you need to refer to other core abstractions covered in other chapters, ALWAYS use proper Markdown links like this: [Chapter Title](filename.md). Use the Complete Tutorial Structure below to find the correct filename and the chapter title.
 
 - Properly use technical terms and software engineering concepts throughout to help the coding AI agent develop with and/or for this project.
 
@@ -620,37 +838,32 @@ content: |
 
 - Ensure the tone is technical and informatory.
 
-Now provide the YAML output for this chapter.
-"""
-        response = call_llm(prompt)
-        yaml_str = response.strip().split("```yaml")[1].rstrip("```")
-        chapter_data = yaml.safe_load(yaml_str)
-
-        # Basic validation/cleanup
-        if not isinstance(chapter_data, dict) or not all(
-            k in chapter_data
-            for k in ["description", "globs", "alwaysApply", "content"]
-        ):
-            raise ValueError(
-                "LLM output is not a dictionary or has missing keys", chapter_data
-            )
+Project: `{project_name}`
 
-        if chapter_data["globs"] is None or (
-            isinstance(chapter_data["globs"], list) and len(chapter_data["globs"]) == 0
-        ):
-            chapter_data["globs"] = " "
-        elif isinstance(chapter_data["globs"], str):
-            chapter_data["globs"] = chapter_data["globs"].strip()
+Complete Tutorial Structure:
+{full_chapter_listing}
 
-        if not all(isinstance(k, str) for k in ["description", "globs", "content"]):
-            raise ValueError(
-                "description, globs or content is not a string", chapter_data
-            )
+Concept Details (chapters {chapter_nums_str}):
+{concepts_str}
+
+Relevant Code Snippets (Code itself remains unchanged):
+{file_context_str if file_context_str else "No specific code snippets provided for these abstractions."}
+
+Now provide the JSON output for chapters {chapter_nums_str}.
+"""
+        response = call_llm(prompt, response_mime_type="application/json")
+        chapters_by_num = parse_chapters(response, chapter_nums)
 
-        if not isinstance(chapter_data["alwaysApply"], bool):
-            raise ValueError("alwaysApply is not a bool", chapter_data["alwaysApply"])
+        return [
+            self._format_chapter(chapters_by_num[item["chapter_num"]], item)
+            for item in batch
+        ]
 
-        chapter_content = chapter_data["content"]
+    def _format_chapter(self, chapter, item):
+        abstraction_name = item["abstraction_details"]["name"]
+        chapter_num = item["chapter_num"]
+
+        chapter_content = chapter.content
         actual_heading = f"# Chapter {chapter_num}: {abstraction_name}"
         if not chapter_content.strip().startswith(f"# Chapter {chapter_num}"):
             # Add heading if missing or incorrect, trying to preserve content
@@ -663,29 +876,21 @@ Now provide the YAML output for this chapter.
             else:  # Otherwise, prepend it
                 chapter_content = f"{actual_heading}\n\n{chapter_content}"
 
-        # prepare the frontmatter and
-        frontmatter = "---\ndescription: "
-        frontmatter += chapter_data["description"].strip()
-        frontmatter += "\nglobs: "
-        frontmatter += chapter_data["globs"].strip()
-        frontmatter += "\nalwaysApply: "
-        frontmatter += "true" if chapter_data["alwaysApply"] else "false"
-        frontmatter += "\n---\n"
-
-        # prepend it to the chapter content
-        chapter_content = frontmatter + chapter_content
-
-        # Add the generated content to our temporary list for the next iteration's context
-        self.chapters_written_so_far.append(chapter_content)
-
-        return chapter_content
+        # Fill the frontmatter and prepend it to the chapter content in one format call
+        return _CHAPTER_TMPL.format_map(
+            {
+                "description": chapter.description.strip(),
+                "globs": chapter.globs.strip(),
+                "always_apply": "true" if chapter.alwaysApply else "false",
+                "content": chapter_content,
+            }
+        )
 
     def post(self, shared, prep_res, exec_res_list):
-        # exec_res_list contains the generated Markdown for each chapter, in order
-        shared["chapters"] = exec_res_list
-        # Clean up the temporary instance variable
-        del self.chapters_written_so_far
-        logging.info(f"Finished writing {len(exec_res_list)} chapters.")
+        # exec_res_list contains the generated Markdown for each batch of chapters, in order
+        chapters = [chapter for batch in exec_res_list for chapter in batch]
+        shared["chapters"] = chapters
+        logging.info(f"Finished writing {len(chapters)} chapters.")
 
 
 class CombineTutorial(Node):
@@ -702,15 +907,16 @@ class CombineTutorial(Node):
         chapter_order = shared["chapter_order"]  # indices
         abstractions = shared["abstractions"]  # list of dicts
         chapters_content = shared["chapters"]  # list of strings
+        chapter_filenames = shared["chapter_filenames"]  # unique names from WriteChapters
 
         # --- Prepare guide.mdc content ---
-        index_content = f"---\ndescription: Guidelines for using {project_name}\nglobs: \nalwaysApply: true\n---\n"
-        index_content += f"{relationships_data['summary']}\n\n"
-        index_content += f"**Source Repository:** [{repo_url}]({repo_url})\n\n"
-
-        index_content += "```\n\n"
-
-        index_content += "## Chapters\n\n"
+        index_parts = [
+            _GUIDE_HEADER_TMPL.format(name=project_name),
+            f"{relationships_data['summary']}\n\n",
+            f"**Source Repository:** [{repo_url}]({repo_url})\n\n",
+            "```\n\n",
+            "## Chapters\n\n",
+        ]
 
         chapter_files = []
         # Generate chapter links based on the determined order, using potentially translated names
@@ -718,56 +924,55 @@ class CombineTutorial(Node):
             # Ensure index is valid and we have content for it
             if 0 <= abstraction_index < len(abstractions) and i < len(chapters_content):
                 abstraction_name = abstractions[abstraction_index]["name"]
-                # Sanitize potentially translated name for filename
-                safe_name = "".join(
-                    c if c.isalnum() else "_" for c in abstraction_name
-                ).lower()
-                filename = f"{safe_name}.mdc"
-                index_content += f"[{abstraction_name}]({filename})\n"
-
-                # Add attribution to chapter content
-                chapter_content = chapters_content[i]
-                if not chapter_content.endswith("\n\n"):
-                    chapter_content += "\n\n"
-                chapter_content += "---\n\nGenerated by [Rules for AI](https://github.com/altaidevorg/rules-for-ai)"
+                filename = chapter_filenames[abstraction_index]["filename"]
+                index_parts.append(f"[{abstraction_name}]({filename})\n")
 
-                # Store filename and corresponding content
-                chapter_files.append({"filename": filename, "content": chapter_content})
+                # Add attribution to chapter content (once, even if prep runs again)
+                chapter_content = chapters_content[i]
+                if not chapter_content.endswith(_ATTRIBUTION):
+                    pad = "" if chapter_content.endswith("\n\n") else "\n\n"
+                    chapter_content = f"{chapter_content}{pad}{_ATTRIBUTION}"
+
+                # Store the full output path and corresponding content
+                chapter_files.append(
+                    (
+                        os.path.join(output_path, filename),
+                        chapter_content.encode("utf-8"),
+                    )
+                )
             else:
                 logging.warning(
                     f"Mismatch between chapter order, abstractions, or content at index {i} (abstraction index {abstraction_index}). Skipping file generation for this entry."
                 )
 
         # Add attribution to index content
-        index_content += "\n\n---\n\nGenerated by [Rules for AI](https://github.com/altaidevorg/rules-for-ai)"
+        index_parts.append(f"\n\n{_ATTRIBUTION}")
+        index_content = "".join(index_parts)
+
+        index_file = (
+            os.path.join(output_path, "guide.mdc"),
+            index_content.encode("utf-8"),
+        )
 
         return {
             "output_path": output_path,
-            "index_content": index_content,
-            "chapter_files": chapter_files,  # List of {"filename": str, "content": str}
+            # List of (path, content bytes), guide.mdc first
+            "files_to_write": [index_file] + chapter_files,
         }
 
     def exec(self, prep_res):
         output_path = prep_res["output_path"]
-        index_content = prep_res["index_content"]
-        chapter_files = prep_res["chapter_files"]
+        files_to_write = prep_res["files_to_write"]
 
         logging.info(f"Combining rules into directory: {output_path}")
         # Rely on Node's built-in retry/fallback
         os.makedirs(output_path, exist_ok=True)
 
-        # Write guide.mdc
-        index_filepath = os.path.join(output_path, "guide.mdc")
-        with open(index_filepath, "w", encoding="utf-8") as f:
-            f.write(index_content)
-        logging.info(f"  - Wrote {index_filepath}")
-
-        # Write chapter files
-        for chapter_info in chapter_files:
-            chapter_filepath = os.path.join(output_path, chapter_info["filename"])
-            with open(chapter_filepath, "w", encoding="utf-8") as f:
-                f.write(chapter_info["content"])
-            logging.info(f"  - Wrote {chapter_filepath}")
+        # Write guide.mdc and the chapter files; the writes are independent, so
+        # they run concurrently
+        with ThreadPoolExecutor(max_workers=min(32, len(files_to_write))) as executor:
+            # list() re-raises the first failed write so Node's retry kicks in
+            list(executor.map(write_output_file, files_to_write))
 
         return output_path  # Return the final path
 
@@ -1,9 +1,26 @@
 from google import genai
 import os
 import logging
-import json
+import hashlib
+import math
+import sqlite3
+import threading
+import zlib
+from array import array
+from concurrent.futures import Future
+from contextlib import closing
 from datetime import datetime
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; semantic lookups fall back to a Python scan
+    np = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; cached responses fall back to zlib
+    zstandard = None
+
 # Configure logging
 log_directory = os.getenv("LOG_DIR", "logs")
 os.makedirs(log_directory, exist_ok=True)
@@ -13,68 +30,355 @@ log_file = os.path.join(
 
 # Set up logger
 logger = logging.getLogger("llm_logger")
-logger.setLevel(logging.INFO)
+# Prompts and responses are logged at INFO; the default WARNING level skips building
+# those (often multi-KB) records. Set LLM_LOG_LEVEL=INFO to keep them.
+log_level_name = (os.getenv("LLM_LOG_LEVEL") or "WARNING").upper()
+log_level = getattr(logging, log_level_name, None)
+unknown_log_level = not isinstance(log_level, int)
+if unknown_log_level:
+    log_level = logging.WARNING
+logger.setLevel(log_level)
 logger.propagate = False  # Prevent propagation to root logger
-file_handler = logging.FileHandler(log_file)
+# delay=True: the log file is only created once something is logged
+file_handler = logging.FileHandler(log_file, delay=True)
 file_handler.setFormatter(
     logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 )
 logger.addHandler(file_handler)
+if unknown_log_level:
+    logger.warning("Unknown LLM_LOG_LEVEL %r, using WARNING", log_level_name)
+
+# Simple cache configuration: a SQLite table keyed by prompt digest, so hits and
+# misses touch a single row instead of the whole cache
+cache_file = "llm_cache.sqlite"
+# Each row keeps the start of its prompt, so the cache can be inspected by hand
+cache_prompt_preview_chars = 200
+
+# One connection shared by the concurrent node workers; the lock serializes its use
+_cache_conn = None
+_cache_lock = threading.Lock()
+
+# Responses are stored compressed: zstd when available, zlib otherwise. Markdown and
+# code compress several-fold, so the cache file stays small.
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+if zstandard is not None:
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+
+# Semantic cache configuration: near-duplicate prompts reuse a cached response
+semantic_cache_file = "llm_semantic_cache.sqlite"
+semantic_cache_threshold = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0.97"))
+# Embedding models truncate long inputs, which would make large prompts look alike
+semantic_cache_max_chars = int(os.getenv("LLM_SEMANTIC_CACHE_MAX_CHARS", "8000"))
+embedding_model = os.getenv("GEMINI_EMBEDDING_MODEL", "text-embedding-004")
+
+# Created lazily so importing this module doesn't require credentials
+_genai_client = None
+_client_lock = threading.Lock()
+
+# Misses currently being generated, keyed by cache key; concurrent callers with
+# the same prompt wait on the owner's Future instead of paying for a second call
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Cached embeddings are kept in memory per (generation model, embedding model)
+# after the first lookup
+_semantic_index = {}
+_semantic_lock = threading.Lock()
+
+
+def _client():
+    # One client per process, so credentials and HTTP connections are reused
+    global _genai_client
+    with _client_lock:
+        if _genai_client is None:
+            _genai_client = genai.Client()
+        return _genai_client
+
+
+def _cache_key(prompt: str, model: str) -> str:
+    # Key by a short digest instead of the raw prompt; the model name is salted in
+    # so switching GEMINI_MODEL doesn't serve responses generated by another model
+    return hashlib.blake2b(
+        f"{model}\n{prompt}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def _get_cache_conn():
+    # Caller must hold _cache_lock
+    global _cache_conn
+    if _cache_conn is None:
+        conn = sqlite3.connect(cache_file, check_same_thread=False)
+        # WAL lets readers proceed during a write; NORMAL sync is safe under WAL
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(k TEXT PRIMARY KEY, v BLOB, prompt_preview TEXT)"
+        )
+        _cache_conn = conn
+    return _cache_conn
+
+
+def _compress_response(response_text: str) -> bytes:
+    # Caller must hold _cache_lock (zstandard compressors aren't thread-safe)
+    data = response_text.encode("utf-8")
+    if zstandard is not None:
+        return _zstd_compressor.compress(data)
+    return zlib.compress(data)
+
+
+def _decompress_response(stored):
+    # Caller must hold _cache_lock
+    if stored.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            return None  # Written by a zstandard-enabled run; treat as a miss
+        return _zstd_decompressor.decompress(stored).decode("utf-8")
+    return zlib.decompress(stored).decode("utf-8")
+
+
+def _cache_lookup(key: str):
+    with _cache_lock:
+        row = _get_cache_conn().execute(
+            "SELECT v FROM cache WHERE k = ?", (key,)
+        ).fetchone()
+        return _decompress_response(row[0]) if row else None
+
+
+def _read_cache(key: str):
+    # Cache read errors are logged and treated as a miss
+    try:
+        return _cache_lookup(key)
+    except Exception as exc:
+        logger.warning("Failed to read cache, skipping it. Reason %s", exc)
+        return None
+
+
+def _store_in_cache(key: str, prompt: str, response_text: str):
+    with _cache_lock:
+        conn = _get_cache_conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (k, v, prompt_preview) VALUES (?, ?, ?)",
+                (
+                    key,
+                    _compress_response(response_text),
+                    prompt[:cache_prompt_preview_chars],
+                ),
+            )
+
+
+def _embed_prompt(client, prompt: str):
+    # Returns the L2-normalized embedding so cosine similarity is a dot product
+    result = client.models.embed_content(model=embedding_model, contents=prompt)
+    values = result.embeddings[0].values
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+def _open_semantic_cache():
+    conn = sqlite3.connect(semantic_cache_file)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS semantic_cache "
+        "(k TEXT PRIMARY KEY, model TEXT, embedding BLOB, response TEXT, "
+        "embedding_model TEXT, scope TEXT)"
+    )
+    return conn
+
 
-# Simple cache configuration
-cache_file = "llm_cache.json"
+def _encode_embedding(embedding) -> bytes:
+    # Packed float32 is ~4x smaller than JSON text and decodes without parsing
+    return array("f", embedding).tobytes()
 
 
-# By default, we Google Gemini 2.5 pro, as it shows great performance for code understanding
-def call_llm(prompt: str, use_cache: bool = True) -> str:
+def _decode_embedding(stored):
+    return array("f", stored).tolist()
+
+
+def _load_semantic_index(model: str, scope: str) -> dict:
+    # Caller must hold _semantic_lock. Reads the scope's rows embedded by the current
+    # embedding model for this generation model from disk once per process.
+    index_key = (model, embedding_model, scope)
+    index = _semantic_index.get(index_key)
+    if index is None:
+        with closing(_open_semantic_cache()) as conn:
+            rows = conn.execute(
+                "SELECT embedding, response FROM semantic_cache "
+                "WHERE model = ? AND embedding_model = ? AND scope = ?",
+                index_key,
+            ).fetchall()
+        index = _semantic_index[index_key] = {
+            "vectors": [_decode_embedding(embedding) for embedding, _ in rows],
+            "responses": [response for _, response in rows],
+            "matrix": None,  # numpy copy of the vectors matching the query size
+            "matrix_rows": None,  # positions in "vectors" of the matrix rows
+        }
+    return index
+
+
+def _semantic_lookup(embedding, model: str, scope: str):
+    # Vectors of another size come from a different vector space and are skipped
+    dim = len(embedding)
+    with _semantic_lock:
+        index = _load_semantic_index(model, scope)
+        if np is not None:
+            # One vectorized matrix-vector product scores every cached prompt
+            if index["matrix"] is None or index["matrix"].shape[1] != dim:
+                rows = [i for i, v in enumerate(index["vectors"]) if len(v) == dim]
+                index["matrix_rows"] = rows
+                index["matrix"] = np.array(
+                    [index["vectors"][i] for i in rows], dtype=np.float32
+                ).reshape(len(rows), dim)
+            if not index["matrix_rows"]:
+                return None
+            scores = index["matrix"] @ np.asarray(embedding, dtype=np.float32)
+            best_row = int(scores.argmax())
+            best = index["matrix_rows"][best_row]
+            best_score = float(scores[best_row])
+        else:
+            candidates = [
+                (sum(a * b for a, b in zip(embedding, vector)), i)
+                for i, vector in enumerate(index["vectors"])
+                if len(vector) == dim
+            ]
+            if not candidates:
+                return None
+            best_score, best = max(candidates)
+        best_response = index["responses"][best]
+    if best_score >= semantic_cache_threshold:
+        logger.info("Semantic cache hit (cosine similarity %.4f)", best_score)
+        return best_response
+    return None
+
+
+def _semantic_store(key: str, model: str, scope: str, embedding, response_text: str):
+    with _semantic_lock:
+        with closing(_open_semantic_cache()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO semantic_cache "
+                "(k, model, embedding, response, embedding_model, scope) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    model,
+                    _encode_embedding(embedding),
+                    response_text,
+                    embedding_model,
+                    scope,
+                ),
+            )
+        index = _semantic_index.get((model, embedding_model, scope))
+        if index is not None:
+            index["vectors"].append(embedding)
+            index["responses"].append(response_text)
+            index["matrix"] = None
+
+
+# By default, we Google Gemini 2.5 pro, as it shows great performance for code understanding.
+# semantic_scope (e.g. the crawled repository) enables the semantic cache tier; only
+# responses cached under the same scope can be reused for near-duplicate prompts.
+def call_llm(
+    prompt: str,
+    use_cache: bool = True,
+    semantic_scope: str = None,
+    response_mime_type: str = None,
+) -> str:
     # Log the prompt
-    logger.info(f"PROMPT: {prompt}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("PROMPT: %s", prompt)
+
+    model = os.getenv("GEMINI_MODEL", "gemini-2.5-pro-preview-03-25")
+    key = _cache_key(prompt, model)
 
     # Check cache if enabled
     if use_cache:
-        # Load cache from disk
-        cache = {}
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, "r") as f:
-                    cache = json.load(f)
-            except Exception as exc:
-                logger.warning(
-                    f"Failed to load cache, starting with empty cache. Reason {exc}"
+        # Return from cache if exists
+        cached_response = _read_cache(key)
+        if cached_response is not None:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("RESPONSE: %s", cached_response)
+            return cached_response
+
+        # Coalesce with an identical request another worker already has in flight.
+        # Retries skip the semantic tier, so they don't join a first attempt's request.
+        inflight_key = (key, semantic_scope)
+        with _inflight_lock:
+            future = _inflight.get(inflight_key)
+            is_owner = future is None
+            if is_owner:
+                future = _inflight[inflight_key] = Future()
+        if not is_owner:
+            logger.info("Waiting for an identical in-flight request")
+            return future.result()
+
+        try:
+            # A previous owner may have stored the response and left between our
+            # cache miss and taking ownership; don't pay for the same prompt twice
+            response_text = _read_cache(key)
+            if response_text is None:
+                response_text = _generate(
+                    prompt, model, key, use_cache, semantic_scope, response_mime_type
                 )
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(response_text)
+        finally:
+            # Later callers find the stored response through the cache lookup
+            with _inflight_lock:
+                del _inflight[inflight_key]
+        return response_text
 
-        # Return from cache if exists
-        if prompt in cache:
-            logger.info(f"RESPONSE: {cache[prompt]}")
-            return cache[prompt]
+    return _generate(prompt, model, key, use_cache, semantic_scope, response_mime_type)
+
+
+# Helper for the miss path: semantic lookup, the actual LLM call and the cache updates
+def _generate(prompt, model, key, use_cache, semantic_scope, response_mime_type):
+    client = _client()
+
+    # On an exact miss, look for a cached response to a near-duplicate prompt
+    embedding = None
+    if (
+        use_cache
+        and semantic_scope is not None
+        and len(prompt) <= semantic_cache_max_chars
+    ):
+        try:
+            embedding = _embed_prompt(client, prompt)
+            cached_response = _semantic_lookup(embedding, model, semantic_scope)
+            if cached_response is not None:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("RESPONSE: %s", cached_response)
+                return cached_response
+        except Exception as exc:
+            logger.warning("Semantic cache lookup failed, skipping it. Reason %s", exc)
+            embedding = None
 
     # Call the LLM if not in cache or cache disabled
-    client = genai.Client()
-    model = os.getenv("GEMINI_MODEL", "gemini-2.5-pro-preview-03-25")
-    response = client.models.generate_content(model=model, contents=[prompt])
+    # e.g. "application/json" constrains the model to emit valid JSON
+    config = {"response_mime_type": response_mime_type} if response_mime_type else None
+    response = client.models.generate_content(
+        model=model, contents=[prompt], config=config
+    )
     response_text = response.text
 
     # Log the response
-    logger.info(f"RESPONSE: {response_text}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("RESPONSE: %s", response_text)
 
     # Update cache if enabled
     if use_cache:
-        # Load cache again to avoid overwrites
-        cache = {}
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, "r") as f:
-                    cache = json.load(f)
-            except Exception as exc:
-                logger.debug(f"No previous cache found: {exc}")
-
-        # Add to cache and save
-        cache[prompt] = response_text
         try:
-            with open(cache_file, "w") as f:
-                json.dump(cache, f)
+            _store_in_cache(key, prompt, response_text)
         except Exception as exc:
-            logger.error(f"Failed to save cache: {exc}")
+            logger.error("Failed to save cache: %s", exc)
+
+        if embedding is not None:
+            try:
+                _semantic_store(key, model, semantic_scope, embedding, response_text)
+            except Exception as exc:
+                logger.error("Failed to save semantic cache: %s", exc)
 
     return response_text
 
@@ -1,20 +1,23 @@
 import requests
 import base64
 import os
+import re
 import tempfile
 import git
 import time
-import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Set, List, Dict, Tuple, Any
 from urllib.parse import urlparse
+from utils.patterns import compile_patterns, path_matches
 
 def crawl_github_files(
     repo_url, 
     token=None, 
     max_file_size: int = 1 * 1024 * 1024,  # 1 MB
     use_relative_paths: bool = False,
-    include_patterns: Union[str, Set[str]] = None,
-    exclude_patterns: Union[str, Set[str]] = None
+    include_patterns: Union[str, Set[str], re.Pattern] = None,
+    exclude_patterns: Union[str, Set[str], re.Pattern] = None,
+    max_workers: int = 4
 ):
     """
     Crawl files from a specific path in a GitHub repository at a specific commit.
@@ -28,34 +31,33 @@ def crawl_github_files(
             - Can be passed explicitly or set via the `GITHUB_TOKEN` environment variable.
         max_file_size (int, optional): Maximum file size in bytes to download (default: 1 MB)
         use_relative_paths (bool, optional): If True, file paths will be relative to the specified subdirectory
-        include_patterns (str or set of str, optional): Pattern or set of patterns specifying which files to include (e.g., "*.py", {"*.md", "*.txt"}).
-                                                       If None, all files are included.
-        exclude_patterns (str or set of str, optional): Pattern or set of patterns specifying which files to exclude.
-                                                       If None, no files are excluded.
+        include_patterns (str, set of str or re.Pattern, optional): Pattern or set of patterns specifying which files to include (e.g., "*.py", {"*.md", "*.txt"}),
+                                                       or a matcher from utils.patterns.compile_patterns. If None, all files are included.
+        exclude_patterns (str, set of str or re.Pattern, optional): Pattern or set of patterns specifying which files to exclude,
+                                                       or a matcher from utils.patterns.compile_patterns. If None, no files are excluded.
+        max_workers (int, optional): Number of concurrent GitHub API requests (default: 4). GitHub discourages
+                                     concurrent requests per token, so keep this small to avoid secondary rate limits.
 
     Returns:
         dict: Dictionary with files and statistics
     """
-    # Convert single pattern to set
-    if include_patterns and isinstance(include_patterns, str):
-        include_patterns = {include_patterns}
-    if exclude_patterns and isinstance(exclude_patterns, str):
-        exclude_patterns = {exclude_patterns}
+    # Compile all patterns into one matcher each, once per crawl
+    include_matcher = compile_patterns(include_patterns)
+    exclude_matcher = compile_patterns(exclude_patterns)
 
     def should_include_file(file_path: str, file_name: str) -> bool:
         """Determine if a file should be included based on patterns"""
         # If no include patterns are specified, include all files
-        if not include_patterns:
+        if include_matcher is None:
             include_file = True
         else:
             # Check if file matches any include pattern
-            include_file = any(fnmatch.fnmatch(file_name, pattern) for pattern in include_patterns)
+            include_file = path_matches(include_matcher, file_name)
 
         # If exclude patterns are specified, check if file should be excluded
-        if exclude_patterns and include_file:
+        if exclude_matcher is not None and include_file:
             # Exclude if file matches any exclude pattern
-            exclude_file = any(fnmatch.fnmatch(file_path, pattern) for pattern in exclude_patterns)
-            return not exclude_file
+            return not path_matches(exclude_matcher, file_path)
 
         return include_file
 
@@ -210,20 +212,45 @@ def crawl_github_files(
     # Dictionary to store path -> content mapping
     files = {}
     skipped_files = []
-    
+
+    # Share one session (and its connection pool) across the worker threads
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+
+    def get_with_rate_limit(url, params=None):
+        """GET a GitHub URL, waiting and retrying while a primary or secondary rate limit is hit"""
+        backoff = 60  # GitHub asks for at least a minute when it gives no other hint
+        while True:
+            response = session.get(url, params=params)
+            if response.status_code not in (403, 429):
+                return response
+
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                # Secondary rate limits usually say how long to wait
+                wait_time = int(retry_after)
+            elif response.headers.get('X-RateLimit-Remaining') == '0':
+                # Primary rate limit: wait until the quota resets
+                reset_time = int(response.headers.get('X-RateLimit-Reset', 0))
+                wait_time = max(reset_time - time.time(), 0) + 1
+            elif response.status_code == 429 or 'rate limit' in response.text.lower():
+                # Secondary rate limit without a hint: back off exponentially
+                wait_time = backoff
+                backoff = min(backoff * 2, 15 * 60)
+            else:
+                # A plain 403 (e.g. missing permissions) is not retryable
+                return response
+
+            print(f"Rate limit exceeded. Waiting for {wait_time:.0f} seconds...")
+            time.sleep(wait_time)
+
     def fetch_contents(path):
-        """Fetch contents of the repository at a specific path and commit"""
+        """Fetch the directory listing of the repository at a specific path and commit"""
         url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
         params = {"ref": ref} if ref != None else {}
         
-        response = requests.get(url, headers=headers, params=params)
-        
-        if response.status_code == 403 and 'rate limit exceeded' in response.text.lower():
-            reset_time = int(response.headers.get('X-RateLimit-Reset', 0))
-            wait_time = max(reset_time - time.time(), 0) + 1
-            print(f"Rate limit exceeded. Waiting for {wait_time:.0f} seconds...")
-            time.sleep(wait_time)
-            return fetch_contents(path)
+        response = get_with_rate_limit(url, params=params)
             
         if response.status_code == 404:
             if not token:
@@ -235,88 +262,104 @@ def crawl_github_files(
             else:
                 print(f"Error 404: Path '{path}' not found in repository or insufficient permissions with the provided token.\n"
                       f"Please verify the token has access to this repository and the path exists.")
-            return
+            return []
             
         if response.status_code != 200:
             print(f"Error fetching {path}: {response.status_code} - {response.text}")
-            return
+            return []
         
         contents = response.json()
         
         # Handle both single file and directory responses
         if not isinstance(contents, list):
             contents = [contents]
+        return contents
+
+    def fetch_file(item):
+        """Download a single file item, returning (rel_path, content) or None if skipped"""
+        item_path = item["path"]
         
-        for item in contents:
-            item_path = item["path"]
-            
-            # Calculate relative path if requested
-            if use_relative_paths and specific_path:
-                # Make sure the path is relative to the specified subdirectory
-                if item_path.startswith(specific_path):
-                    rel_path = item_path[len(specific_path):].lstrip('/')
-                else:
-                    rel_path = item_path
+        # Calculate relative path if requested
+        if use_relative_paths and specific_path:
+            # Make sure the path is relative to the specified subdirectory
+            if item_path.startswith(specific_path):
+                rel_path = item_path[len(specific_path):].lstrip('/')
             else:
                 rel_path = item_path
+        else:
+            rel_path = item_path
+        
+        # Check if file should be included based on patterns
+        if not should_include_file(rel_path, item["name"]):
+            print(f"Skipping {rel_path}: Does not match include/exclude patterns")
+            return None
+        
+        # Check file size if available
+        file_size = item.get("size", 0)
+        if file_size > max_file_size:
+            skipped_files.append((item_path, file_size))
+            print(f"Skipping {rel_path}: File size ({file_size} bytes) exceeds limit ({max_file_size} bytes)")
+            return None
+        
+        # For files, get raw content
+        if "download_url" in item and item["download_url"]:
+            file_url = item["download_url"]
+            file_response = get_with_rate_limit(file_url)
             
-            if item["type"] == "file":
-                # Check if file should be included based on patterns
-                if not should_include_file(rel_path, item["name"]):
-                    print(f"Skipping {rel_path}: Does not match include/exclude patterns")
-                    continue
+            # Final size check in case content-length header is available but differs from metadata
+            content_length = int(file_response.headers.get('content-length', 0))
+            if content_length > max_file_size:
+                skipped_files.append((item_path, content_length))
+                print(f"Skipping {rel_path}: Content length ({content_length} bytes) exceeds limit ({max_file_size} bytes)")
+                return None
                 
-                # Check file size if available
-                file_size = item.get("size", 0)
-                if file_size > max_file_size:
-                    skipped_files.append((item_path, file_size))
-                    print(f"Skipping {rel_path}: File size ({file_size} bytes) exceeds limit ({max_file_size} bytes)")
-                    continue
+            if file_response.status_code == 200:
+                print(f"Downloaded: {rel_path} ({file_size} bytes) ")
+                return rel_path, file_response.text
+            print(f"Failed to download {rel_path}: {file_response.status_code}")
+            return None
+        
+        # Alternative method if download_url is not available
+        content_response = get_with_rate_limit(item["url"])
+        if content_response.status_code != 200:
+            print(f"Failed to get content for {rel_path}: {content_response.status_code}")
+            return None
+        
+        content_data = content_response.json()
+        if content_data.get("encoding") == "base64" and "content" in content_data:
+            # Check size of base64 content before decoding
+            if len(content_data["content"]) * 0.75 > max_file_size:  # Approximate size calculation
+                estimated_size = int(len(content_data["content"]) * 0.75)
+                skipped_files.append((item_path, estimated_size))
+                print(f"Skipping {rel_path}: Encoded content exceeds size limit")
+                return None
                 
-                # For files, get raw content
-                if "download_url" in item and item["download_url"]:
-                    file_url = item["download_url"]
-                    file_response = requests.get(file_url, headers=headers)
-                    
-                    # Final size check in case content-length header is available but differs from metadata
-                    content_length = int(file_response.headers.get('content-length', 0))
-                    if content_length > max_file_size:
-                        skipped_files.append((item_path, content_length))
-                        print(f"Skipping {rel_path}: Content length ({content_length} bytes) exceeds limit ({max_file_size} bytes)")
-                        continue
-                        
-                    if file_response.status_code == 200:
-                        files[rel_path] = file_response.text
-                        print(f"Downloaded: {rel_path} ({file_size} bytes) ")
-                    else:
-                        print(f"Failed to download {rel_path}: {file_response.status_code}")
-                else:
-                    # Alternative method if download_url is not available
-                    content_response = requests.get(item["url"], headers=headers)
-                    if content_response.status_code == 200:
-                        content_data = content_response.json()
-                        if content_data.get("encoding") == "base64" and "content" in content_data:
-                            # Check size of base64 content before decoding
-                            if len(content_data["content"]) * 0.75 > max_file_size:  # Approximate size calculation
-                                estimated_size = int(len(content_data["content"]) * 0.75)
-                                skipped_files.append((item_path, estimated_size))
-                                print(f"Skipping {rel_path}: Encoded content exceeds size limit")
-                                continue
-                                
-                            file_content = base64.b64decode(content_data["content"]).decode('utf-8')
-                            files[rel_path] = file_content
-                            print(f"Downloaded: {rel_path} ({file_size} bytes)")
-                        else:
-                            print(f"Unexpected content format for {rel_path}")
-                    else:
-                        print(f"Failed to get content for {rel_path}: {content_response.status_code}")
-            
-            elif item["type"] == "dir":
-                # Recursively process subdirectories
-                fetch_contents(item_path)
+            file_content = base64.b64decode(content_data["content"]).decode('utf-8')
+            print(f"Downloaded: {rel_path} ({file_size} bytes)")
+            return rel_path, file_content
+        
+        print(f"Unexpected content format for {rel_path}")
+        return None
     
-    # Start crawling from the specified path
-    fetch_contents(specific_path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Walk the tree one level at a time, listing the directories of a level concurrently
+        file_items = []
+        pending_dirs = [specific_path]
+        while pending_dirs:
+            next_dirs = []
+            for contents in executor.map(fetch_contents, pending_dirs):
+                for item in contents:
+                    if item["type"] == "file":
+                        file_items.append(item)
+                    elif item["type"] == "dir":
+                        next_dirs.append(item["path"])
+            pending_dirs = next_dirs
+        
+        # Download files concurrently; map keeps the listing order so file indices are stable across runs
+        for result in executor.map(fetch_file, file_items):
+            if result is not None:
+                rel_path, content = result
+                files[rel_path] = content
     
     return {
         "files": files,
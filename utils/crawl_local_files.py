@@ -1,5 +1,5 @@
 import os
-import fnmatch
+from utils.patterns import compile_patterns, path_matches
 
 def crawl_local_files(directory, include_patterns=None, exclude_patterns=None, max_file_size=None, use_relative_paths=True):
     """
@@ -7,8 +7,8 @@ def crawl_local_files(directory, include_patterns=None, exclude_patterns=None, m
     
     Args:
         directory (str): Path to local directory
-        include_patterns (set): File patterns to include (e.g. {"*.py", "*.js"})
-        exclude_patterns (set): File patterns to exclude (e.g. {"tests/*"})
+        include_patterns (set or re.Pattern): File patterns to include (e.g. {"*.py", "*.js"}) or a compiled matcher
+        exclude_patterns (set or re.Pattern): File patterns to exclude (e.g. {"tests/*"}) or a compiled matcher
         max_file_size (int): Maximum file size in bytes
         use_relative_paths (bool): Whether to use paths relative to directory
         
@@ -19,6 +19,9 @@ def crawl_local_files(directory, include_patterns=None, exclude_patterns=None, m
         raise ValueError(f"Directory does not exist: {directory}")
         
     files_dict = {}
+    # Compile all patterns into one matcher each, once per crawl
+    include_matcher = compile_patterns(include_patterns)
+    exclude_matcher = compile_patterns(exclude_patterns)
     
     for root, _, files in os.walk(directory):
         for filename in files:
@@ -31,22 +34,10 @@ def crawl_local_files(directory, include_patterns=None, exclude_patterns=None, m
                 relpath = filepath
                 
             # Check if file matches any include pattern
-            included = False
-            if include_patterns:
-                for pattern in include_patterns:
-                    if fnmatch.fnmatch(relpath, pattern):
-                        included = True
-                        break
-            else:
-                included = True
+            included = include_matcher is None or path_matches(include_matcher, relpath)
                 
             # Check if file matches any exclude pattern
-            excluded = False
-            if exclude_patterns:
-                for pattern in exclude_patterns:
-                    if fnmatch.fnmatch(relpath, pattern):
-                        excluded = True
-                        break
+            excluded = exclude_matcher is not None and path_matches(exclude_matcher, relpath)
                         
             if not included or excluded:
                 continue
@@ -0,0 +1,47 @@
+import fnmatch
+import os
+import re
+
+
+def compile_patterns(patterns):
+    """
+    Compile glob patterns into a single regex matcher, so each path is checked with
+    one match() call instead of one fnmatch call per pattern. Like fnmatch.fnmatch,
+    patterns are normalized with os.path.normcase; check paths with path_matches().
+
+    Args:
+        patterns (str, set of str or re.Pattern): Glob pattern(s) (e.g. "*.py", {"tests/*", "docs/*"}).
+                                                  An already compiled matcher is returned unchanged.
+
+    Returns:
+        re.Pattern or None: Matcher that matches a path if any of the patterns does,
+                            or None if no patterns are given.
+    """
+    if not patterns:
+        return None
+    if isinstance(patterns, re.Pattern):
+        return patterns
+    if isinstance(patterns, str):
+        patterns = {patterns}
+    return re.compile(
+        "|".join(
+            f"(?:{fnmatch.translate(os.path.normcase(p))})" for p in sorted(patterns)
+        )
+    )
+
+
+def path_matches(matcher, path):
+    """
+    Check a path against a matcher from compile_patterns.
+
+    The path gets the same os.path.normcase treatment as the patterns, so on Windows
+    backslash-separated and differently cased paths match as they do with fnmatch.
+    """
+    return matcher.match(os.path.normcase(path)) is not None
+
+
+if __name__ == "__main__":
+    matcher = compile_patterns({"*.py", "tests/*", "node_modules/*"})
+    nested = os.path.join("node_modules", "lib", "x.js")
+    for path in ["main.py", "tests/data.json", nested, "README.md"]:
+        print(f"{path}: {path_matches(matcher, path)}")